@@ -24,6 +24,9 @@ OPENAI_IMAGE_MODEL: str = os.getenv("OPENAI_IMAGE_MODEL", "gpt-image-1-mini")
 
 # Пути к данным
 PROMPTS_JSON_PATH: Path = BASE_DIR / "prompts.json"
+# Память диалогов: по файлу на чат (memory/<chat_id>.json.gz)
+MEMORY_DIR: Path = BASE_DIR / "memory"
+# Прежний общий файл памяти — переносится в MEMORY_DIR при первом запуске
 MEMORY_JSON_PATH: Path = BASE_DIR / "memory.json"
 
 # Лимиты контекста (по заданию — по 10 сообщений)
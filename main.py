@@ -1,8 +1,13 @@
 # main.py — точка входа, роутеры и обработчики бота
 
 import asyncio
-import base64
+import functools
 import logging
+import random
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from operator import attrgetter
+from typing import TYPE_CHECKING, TypeVar
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ChatAction
@@ -16,23 +21,24 @@ from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
 )
-from openai import AsyncOpenAI
 
 import config
 from memory import (
-    add_tokens,
-    append_assistant_message,
-    append_user_message,
+    apply_turn,
+    build_turn_messages,
     get_chat_stats,
-    get_messages_for_api,
     get_prompts_data,
-    get_system_prompt,
+    maybe_reload_prompts,
+    get_system_message,
     get_chat_state,
     reset_chat,
     reset_chat_stats,
     set_chat_mode,
 )
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
 # ---------------------------------------------------------------------------
 # config
 # ---------------------------------------------------------------------------
@@ -47,140 +53,272 @@ logger = logging.getLogger(__name__)
 TELEGRAM_MESSAGE_LIMIT = 4096
 
 router = Router()
-openai_client: AsyncOpenAI | None = None
-
-# Чаты, ожидающие ввод описания для генерации изображения
-_chats_waiting_image_prompt: set[int] = set()
-# Чаты в меню настроек изображения (после нажатия «Картинка»)
-_chats_in_image_menu: set[int] = set()
-# Настройки генерации изображения по чатам
-_image_settings: dict[int, dict[str, str]] = {}
-
-DEFAULT_IMAGE_SETTINGS = {
-    "quality": "low",
-    "size": "1024x1536",
-    "background": "auto",
-    "output_format": "png",
-}
+openai_client: "AsyncOpenAI | None" = None
+
+
+@dataclass(slots=True)
+class ImageSettings:
+    """Настройки генерации изображения для чата (для gpt-image-*)."""
+
+    quality: str = "low"
+    size: str = "1024x1536"
+    background: str = "auto"
+    output_format: str = "png"
+
+
+@dataclass(slots=True)
+class ChatUIState:
+    """Состояние интерфейса чата: меню изображений, ожидание описания, настройки."""
+
+    # Чат в меню настроек изображения (после нажатия «Картинка»)
+    in_image_menu: bool = False
+    # Чат ожидает ввод описания для генерации изображения
+    waiting_image_prompt: bool = False
+    settings: ImageSettings = field(default_factory=ImageSettings)
+
+
+# Состояние интерфейса по чатам
+_ui: dict[int, ChatUIState] = {}
+# Состояние по умолчанию для чтения без создания записи (не изменять)
+_EMPTY_UI = ChatUIState()
+
+
+# Таймауты запросов к OpenAI, секунды: чат и генерация изображения (она заметно дольше)
+OPENAI_TIMEOUT = 60.0
+OPENAI_IMAGE_TIMEOUT = 180.0
 
+# Геттеры (входящие, исходящие) токенов из usage — определяются по первому ответу API
+_usage_getters: tuple[attrgetter, attrgetter] | None = None
 
-def get_openai_client() -> AsyncOpenAI:
+
+def _usage_tokens(usage) -> tuple[int, int]:
+    """Входящие/исходящие токены из usage: input_tokens/output_tokens или prompt_tokens/completion_tokens."""
+    global _usage_getters
+    if _usage_getters is None:
+        if hasattr(usage, "input_tokens"):
+            _usage_getters = (attrgetter("input_tokens"), attrgetter("output_tokens"))
+        else:
+            _usage_getters = (attrgetter("prompt_tokens"), attrgetter("completion_tokens"))
+    get_in, get_out = _usage_getters
+    return get_in(usage) or 0, get_out(usage) or 0
+
+
+def get_openai_client() -> "AsyncOpenAI":
     global openai_client
     if openai_client is None:
-        openai_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+        # openai импортируется лениво — при первом запросе, а не при старте бота
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        # Один клиент на всё время работы: HTTP/2 мультиплексирует запросы разных чатов
+        # в общих соединениях, пул расширен под пиковую нагрузку. DefaultAsyncHttpxClient
+        # сохраняет остальные настройки HTTP-клиента SDK (например, следование редиректам).
+        # Повторы выполняет _with_retries — встроенные повторы SDK отключены, чтобы не умножать их.
+        openai_client = AsyncOpenAI(
+            api_key=config.OPENAI_API_KEY,
+            max_retries=0,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+            ),
+        )
     return openai_client
 
 
-# ---------------------------------------------------------------------------
-# Клавиатура с командами (кнопки)
-# ---------------------------------------------------------------------------
+async def close_openai_client() -> None:
+    """Закрыть клиент OpenAI и его соединения (при остановке бота)."""
+    global openai_client
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
 
-def build_main_keyboard() -> ReplyKeyboardMarkup:
-    """Клавиатура с командами в виде удобочитаемых кнопок."""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Перезапуск"), KeyboardButton(text="Режим")],
-            [KeyboardButton(text="Очистить историю"), KeyboardButton(text="Статистика")],
-            [KeyboardButton(text="Обнулить статистику"), KeyboardButton(text="Картинка")],
-        ],
-        resize_keyboard=True,
-    )
 
+# Число попыток запроса к OpenAI при временных ошибках (429, 408, 409, 5xx) и сетевых сбоях
+OPENAI_ATTEMPTS = 3
+# Коды ответа, при которых запрос повторяется (как в повторах самого SDK), кроме 5xx
+_RETRY_STATUS_CODES = frozenset({408, 409, 429})
+# Верхняя граница ожидания по Retry-After, чтобы пользователь не ждал минутами
+OPENAI_MAX_RETRY_AFTER = 20.0
 
-def build_image_settings_keyboard() -> ReplyKeyboardMarkup:
-    """Клавиатура настроек генерации изображения."""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Качество"), KeyboardButton(text="Размер")],
-            [KeyboardButton(text="Фон"), KeyboardButton(text="Формат")],
-            [KeyboardButton(text="Ввести описание"), KeyboardButton(text="Выйти")],
-        ],
-        resize_keyboard=True,
-    )
+_T = TypeVar("_T")
 
 
-def get_image_settings(chat_id: int) -> dict[str, str]:
-    """Получить настройки изображения для чата (с подстановкой значений по умолчанию)."""
-    if chat_id not in _image_settings:
-        _image_settings[chat_id] = DEFAULT_IMAGE_SETTINGS.copy()
-    return _image_settings[chat_id]
+def _retry_after(error: Exception) -> float | None:
+    """Задержка из заголовка Retry-After ответа OpenAI (в секундах, не больше OPENAI_MAX_RETRY_AFTER)."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = float(value) if value is not None else None
+    except ValueError:
+        return None
+    if delay is None:
+        return None
+    return min(max(delay, 0.0), OPENAI_MAX_RETRY_AFTER)
 
 
-def build_quality_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="low", callback_data="img_q:low")],
-        [InlineKeyboardButton(text="medium", callback_data="img_q:medium")],
-        [InlineKeyboardButton(text="high", callback_data="img_q:high")],
-        [InlineKeyboardButton(text="auto", callback_data="img_q:auto")],
-    ])
+async def _with_retries(
+    make_request: Callable[[], Awaitable[_T]], retry_timeouts: bool = True
+) -> _T:
+    """
+    Выполнить запрос к OpenAI с повторами: при 429, 408, 409 и 5xx — экспоненциальная задержка
+    с джиттером (или Retry-After), при сетевой ошибке — короткая пауза. Остальные ошибки
+    (ключ, неверный запрос и т.п.) сразу пробрасываются.
+    retry_timeouts=False — не повторять запрос, упавший по таймауту: каждая попытка может длиться
+    до OPENAI_TIMEOUT, и пользователь ждал бы ответа минутами.
+    """
+    import openai
 
+    for attempt in range(OPENAI_ATTEMPTS):
+        is_last = attempt == OPENAI_ATTEMPTS - 1
+        try:
+            return await make_request()
+        except openai.APITimeoutError:
+            if is_last or not retry_timeouts:
+                raise
+            delay = 0.5 * (attempt + 1)
+        except openai.APIConnectionError:
+            if is_last:
+                raise
+            delay = 0.5 * (attempt + 1)
+        except openai.APIStatusError as e:
+            if is_last or not (e.status_code in _RETRY_STATUS_CODES or e.status_code >= 500):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(2**attempt + random.random(), 8)
+        logger.warning("OpenAI недоступен, попытка %s/%s через %.1f с", attempt + 2, OPENAI_ATTEMPTS, delay)
+        await asyncio.sleep(delay)
 
-def build_size_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Square 1024×1024", callback_data="img_s:1024x1024")],
-        [InlineKeyboardButton(text="Portrait 1024×1536", callback_data="img_s:1024x1536")],
-        [InlineKeyboardButton(text="Landscape 1536×1024", callback_data="img_s:1536x1024")],
-        [InlineKeyboardButton(text="auto", callback_data="img_s:auto")],
-    ])
 
+# ---------------------------------------------------------------------------
+# Клавиатура с командами (кнопки)
+# ---------------------------------------------------------------------------
 
-def build_background_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="transparent", callback_data="img_bg:transparent")],
-        [InlineKeyboardButton(text="opaque", callback_data="img_bg:opaque")],
-        [InlineKeyboardButton(text="auto", callback_data="img_bg:auto")],
-    ])
+# Клавиатуры неизменяемы — создаются один раз при импорте.
 
+# Клавиатура с командами в виде удобочитаемых кнопок
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Перезапуск"), KeyboardButton(text="Режим")],
+        [KeyboardButton(text="Очистить историю"), KeyboardButton(text="Статистика")],
+        [KeyboardButton(text="Обнулить статистику"), KeyboardButton(text="Картинка")],
+    ],
+    resize_keyboard=True,
+)
 
-def build_format_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="png", callback_data="img_fmt:png")],
-        [InlineKeyboardButton(text="webp", callback_data="img_fmt:webp")],
-        [InlineKeyboardButton(text="jpeg", callback_data="img_fmt:jpeg")],
-    ])
+# Клавиатура настроек генерации изображения
+IMAGE_SETTINGS_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Качество"), KeyboardButton(text="Размер")],
+        [KeyboardButton(text="Фон"), KeyboardButton(text="Формат")],
+        [KeyboardButton(text="Ввести описание"), KeyboardButton(text="Выйти")],
+    ],
+    resize_keyboard=True,
+)
+
+
+def get_ui(chat_id: int) -> ChatUIState:
+    """Получить состояние интерфейса чата (создаётся при первом обращении)."""
+    ui = _ui.get(chat_id)
+    if ui is None:
+        ui = _ui[chat_id] = ChatUIState()
+    return ui
+
+
+def get_image_settings(chat_id: int) -> ImageSettings:
+    """Получить настройки изображения для чата (с подстановкой значений по умолчанию)."""
+    return get_ui(chat_id).settings
+
+
+QUALITY_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="low", callback_data="img_q:low")],
+    [InlineKeyboardButton(text="medium", callback_data="img_q:medium")],
+    [InlineKeyboardButton(text="high", callback_data="img_q:high")],
+    [InlineKeyboardButton(text="auto", callback_data="img_q:auto")],
+])
+
+SIZE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Square 1024×1024", callback_data="img_s:1024x1024")],
+    [InlineKeyboardButton(text="Portrait 1024×1536", callback_data="img_s:1024x1536")],
+    [InlineKeyboardButton(text="Landscape 1536×1024", callback_data="img_s:1536x1024")],
+    [InlineKeyboardButton(text="auto", callback_data="img_s:auto")],
+])
+
+BACKGROUND_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="transparent", callback_data="img_bg:transparent")],
+    [InlineKeyboardButton(text="opaque", callback_data="img_bg:opaque")],
+    [InlineKeyboardButton(text="auto", callback_data="img_bg:auto")],
+])
+
+FORMAT_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="png", callback_data="img_fmt:png")],
+    [InlineKeyboardButton(text="webp", callback_data="img_fmt:webp")],
+    [InlineKeyboardButton(text="jpeg", callback_data="img_fmt:jpeg")],
+])
+
+
+_SIZE_LABELS = {
+    "1024x1024": "Square 1024×1024",
+    "1024x1536": "Portrait 1024×1536",
+    "1536x1024": "Landscape 1536×1024",
+    "auto": "auto",
+}
+
+_IMAGE_SETTINGS_TEMPLATE = (
+    "Качество: **{quality}**\n"
+    "Размер: **{size}**\n"
+    "Фон: **{background}**\n"
+    "Формат: **{output_format}**"
+)
 
 
 def format_image_settings_text(chat_id: int) -> str:
     """Текст с текущими настройками изображения."""
     s = get_image_settings(chat_id)
-    size_labels = {"1024x1024": "Square 1024×1024", "1024x1536": "Portrait 1024×1536", "1536x1024": "Landscape 1536×1024", "auto": "auto"}
-    return (
-        f"Качество: **{s['quality']}**\n"
-        f"Размер: **{size_labels.get(s['size'], s['size'])}**\n"
-        f"Фон: **{s['background']}**\n"
-        f"Формат: **{s['output_format']}**"
+    return _IMAGE_SETTINGS_TEMPLATE.format(
+        quality=s.quality,
+        size=_SIZE_LABELS.get(s.size, s.size),
+        background=s.background,
+        output_format=s.output_format,
     )
 
 
+@functools.lru_cache(maxsize=4)
+def _mode_keyboard_for(modes: tuple[tuple[str, str], ...]) -> InlineKeyboardMarkup:
+    """Клавиатура режимов по неизменяемому списку пар (ключ, название)."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=name, callback_data=f"mode:{key}")]
+        for key, name in modes
+    ])
+
+
 def build_mode_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора режима ассистента (inline-кнопки)."""
-    prompts_data = get_prompts_data()
-    prompts = prompts_data.get("prompts", {})
-    buttons = [
-        [InlineKeyboardButton(text=data.get("name", key), callback_data=f"mode:{key}")]
-        for key, data in prompts.items()
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    prompts = get_prompts_data().get("prompts", {})
+    modes = tuple((key, data.get("name", key)) for key, data in prompts.items())
+    return _mode_keyboard_for(modes)
 
 
 def split_message(text: str, max_length: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
     """Разбить длинный текст на части не длиннее max_length (по границам строк где возможно)."""
-    if len(text) <= max_length:
+    n = len(text)
+    if n <= max_length:
         return [text] if text else []
     chunks = []
-    rest = text
-    while rest:
-        if len(rest) <= max_length:
-            chunks.append(rest)
+    start = 0
+    while start < n:
+        end = start + max_length
+        if end >= n:
+            chunks.append(text[start:])
             break
-        block = rest[:max_length]
-        last_newline = block.rfind("\n")
-        if last_newline > max_length // 2:
-            cut = last_newline + 1
-        else:
-            cut = max_length
-        chunks.append(rest[:cut])
-        rest = rest[cut:].lstrip("\n")
+        # Перенос строки ищем только во второй половине блока, без копирования блока
+        last_newline = text.rfind("\n", start + max_length // 2 + 1, end)
+        cut = last_newline + 1 if last_newline != -1 else end
+        chunks.append(text[start:cut])
+        while cut < n and text[cut] == "\n":
+            cut += 1
+        start = cut
     return chunks
 
 
@@ -191,10 +329,11 @@ async def keep_typing(bot: Bot, chat_id: int, stop_event: asyncio.Event) -> None
             await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
         except Exception:
             break
-        await asyncio.wait(
-            [stop_event.wait(), asyncio.sleep(4)],
-            return_when=asyncio.FIRST_COMPLETED,
-        )
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=4.0)
+            return
+        except asyncio.TimeoutError:
+            continue
 
 
 # ---------------------------------------------------------------------------
@@ -208,7 +347,7 @@ async def cmd_start(message: Message) -> None:
     prompts_data = get_prompts_data()
     default_key = prompts_data.get("default_prompt", "assistant")
     state = get_chat_state(message.chat.id)
-    current_mode = state.get("mode") or default_key
+    current_mode = state.mode or default_key
     mode_info = prompts_data["prompts"].get(current_mode, {})
     mode_name = mode_info.get("name", current_mode)
     text = (
@@ -219,7 +358,7 @@ async def cmd_start(message: Message) -> None:
         "• Очистить историю — сбросить диалог\n\n"
         "Просто напиши сообщение — я отвечу с учётом контекста."
     )
-    await message.answer(text, reply_markup=build_main_keyboard(), parse_mode="Markdown")
+    await message.answer(text, reply_markup=MAIN_KEYBOARD, parse_mode="Markdown")
 
 
 # ---------------------------------------------------------------------------
@@ -230,7 +369,8 @@ async def cmd_start(message: Message) -> None:
 @router.message(F.text == "Режим")
 async def cmd_mode(message: Message) -> None:
     """Показать список режимов и кнопки выбора режима ассистента."""
-    prompts_data = get_prompts_data()
+    # Правки prompts.json подхватываются при открытии списка режимов
+    prompts_data = maybe_reload_prompts()
     prompts = prompts_data.get("prompts", {})
     lines = ["Выбери режим ассистента:\n"]
     for key, data in prompts.items():
@@ -253,7 +393,7 @@ async def cmd_mode(message: Message) -> None:
 async def cmd_reset(message: Message) -> None:
     """Очистить историю диалога для этого чата (статистика токенов не сбрасывается)."""
     reset_chat(message.chat.id)
-    await message.answer("История диалога очищена.", reply_markup=build_main_keyboard())
+    await message.answer("История диалога очищена.", reply_markup=MAIN_KEYBOARD)
 
 
 # ---------------------------------------------------------------------------
@@ -262,6 +402,9 @@ async def cmd_reset(message: Message) -> None:
 
 COST_PER_1M_INPUT = 0.25
 COST_PER_1M_OUTPUT = 2.00
+# Стоимость одного токена — чтобы не делить на миллион при каждом запросе статистики
+_COST_PER_INPUT_TOKEN = COST_PER_1M_INPUT / 1_000_000
+_COST_PER_OUTPUT_TOKEN = COST_PER_1M_OUTPUT / 1_000_000
 
 
 @router.message(Command("stats"))
@@ -269,16 +412,14 @@ COST_PER_1M_OUTPUT = 2.00
 async def cmd_stats(message: Message) -> None:
     """Показать накопительную статистику: запросы, ответы модели, примерная стоимость."""
     input_tok, output_tok = get_chat_stats(message.chat.id)
-    cost = (input_tok / 1_000_000 * COST_PER_1M_INPUT) + (
-        output_tok / 1_000_000 * COST_PER_1M_OUTPUT
-    )
+    cost = input_tok * _COST_PER_INPUT_TOKEN + output_tok * _COST_PER_OUTPUT_TOKEN
     text = (
         "📊 **Статистика использования OpenAI**\n\n"
         f"Запросы пользователя (входящие токены): {input_tok:,}\n"
         f"Ответы модели (исходящие токены): {output_tok:,}\n\n"
         f"Стоимость исходя из вход/выход ${COST_PER_1M_INPUT:.2f}/${COST_PER_1M_OUTPUT:.2f} составила **${cost:.4f}**"
     )
-    await message.answer(text, reply_markup=build_main_keyboard(), parse_mode="Markdown")
+    await message.answer(text, reply_markup=MAIN_KEYBOARD, parse_mode="Markdown")
 
 
 @router.message(Command("reset_stats"))
@@ -286,21 +427,21 @@ async def cmd_stats(message: Message) -> None:
 async def cmd_reset_stats(message: Message) -> None:
     """Обнулить накопительную статистику токенов для этого чата."""
     reset_chat_stats(message.chat.id)
-    await message.answer("Статистика обнулена.", reply_markup=build_main_keyboard())
+    await message.answer("Статистика обнулена.", reply_markup=MAIN_KEYBOARD)
 
 
 # ---------------------------------------------------------------------------
 # handlers: генерация изображения по промпту
 # ---------------------------------------------------------------------------
 
-async def generate_image(prompt: str, settings: dict[str, str] | None = None) -> tuple[bytes | None, str | None]:
+async def generate_image(prompt: str, settings: ImageSettings | None = None) -> tuple[bytes | None, str | None]:
     """
     Сгенерировать изображение по текстовому описанию.
     settings: quality, size, background, output_format (для gpt-image-*).
     Возвращает (bytes, None) при ответе в base64 или (None, url) при ответе по URL.
     При ошибке — (None, None).
     """
-    settings = settings or DEFAULT_IMAGE_SETTINGS
+    settings = settings or ImageSettings()
     try:
         client = get_openai_client()
         kwargs = {
@@ -310,19 +451,28 @@ async def generate_image(prompt: str, settings: dict[str, str] | None = None) ->
         }
         if "dall-e" in config.OPENAI_IMAGE_MODEL.lower():
             kwargs["size"] = "1024x1024"
+            # По URL картинку скачивает сам Telegram — байты не проходят через бота
+            kwargs["response_format"] = "url"
         else:
-            kwargs["quality"] = settings.get("quality", "low")
-            kwargs["size"] = settings.get("size", "1024x1536")
-            kwargs["background"] = settings.get("background", "auto")
-            kwargs["output_format"] = settings.get("output_format", "png")
-        response = await client.images.generate(**kwargs)
+            kwargs["quality"] = settings.quality
+            kwargs["size"] = settings.size
+            kwargs["background"] = settings.background
+            kwargs["output_format"] = settings.output_format
+        # Генерация долгая и платная — по таймауту не повторяем, чтобы не ждать и не платить трижды
+        response = await _with_retries(
+            lambda: client.with_options(timeout=OPENAI_IMAGE_TIMEOUT).images.generate(**kwargs),
+            retry_timeouts=False,
+        )
         if not response.data:
             return (None, None)
         img = response.data[0]
-        if getattr(img, "b64_json", None):
-            return (base64.b64decode(img.b64_json), None)
         if getattr(img, "url", None):
             return (None, img.url)
+        if getattr(img, "b64_json", None):
+            # gpt-image-* отдаёт только base64: декодируем один раз и передаём байты как есть
+            import base64
+
+            return (base64.b64decode(img.b64_json), None)
         return (None, None)
     except Exception as e:
         logger.exception("Image generation failed: %s", e)
@@ -333,8 +483,7 @@ async def generate_image(prompt: str, settings: dict[str, str] | None = None) ->
 async def cmd_image_menu(message: Message) -> None:
     """Показать меню настроек генерации изображения."""
     chat_id = message.chat.id
-    _chats_in_image_menu.add(chat_id)
-    get_image_settings(chat_id)
+    get_ui(chat_id).in_image_menu = True
     text = (
         "Настройки генерации изображения:\n\n"
         f"{format_image_settings_text(chat_id)}\n\n"
@@ -342,110 +491,108 @@ async def cmd_image_menu(message: Message) -> None:
     )
     await message.answer(
         text,
-        reply_markup=build_image_settings_keyboard(),
+        reply_markup=IMAGE_SETTINGS_KEYBOARD,
         parse_mode="Markdown",
     )
 
 
-class ImageMenuFilter(BaseFilter):
-    """Фильтр: чат в режиме настроек изображения."""
-
-    async def __call__(self, message: Message) -> bool:
-        return message.chat.id in _chats_in_image_menu
-
-
-@router.message(ImageMenuFilter(), F.text == "Качество")
 async def cmd_image_quality(message: Message) -> None:
     """Показать выбор качества."""
-    await message.answer("Выберите качество:", reply_markup=build_quality_keyboard())
+    await message.answer("Выберите качество:", reply_markup=QUALITY_KEYBOARD)
 
 
-@router.message(ImageMenuFilter(), F.text == "Размер")
 async def cmd_image_size(message: Message) -> None:
     """Показать выбор размера."""
-    await message.answer("Выберите размер:", reply_markup=build_size_keyboard())
+    await message.answer("Выберите размер:", reply_markup=SIZE_KEYBOARD)
 
 
-@router.message(ImageMenuFilter(), F.text == "Фон")
 async def cmd_image_background(message: Message) -> None:
     """Показать выбор фона."""
-    await message.answer("Выберите фон:", reply_markup=build_background_keyboard())
+    await message.answer("Выберите фон:", reply_markup=BACKGROUND_KEYBOARD)
 
 
-@router.message(ImageMenuFilter(), F.text == "Формат")
 async def cmd_image_format(message: Message) -> None:
     """Показать выбор формата."""
-    await message.answer("Выберите формат файла:", reply_markup=build_format_keyboard())
+    await message.answer("Выберите формат файла:", reply_markup=FORMAT_KEYBOARD)
 
 
-@router.message(ImageMenuFilter(), F.text == "Ввести описание")
 async def cmd_image_enter_prompt(message: Message) -> None:
     """Перейти к вводу описания изображения."""
-    _chats_in_image_menu.discard(message.chat.id)
-    _chats_waiting_image_prompt.add(message.chat.id)
+    ui = get_ui(message.chat.id)
+    ui.in_image_menu = False
+    ui.waiting_image_prompt = True
     await message.answer(
         "Введите описание изображения в следующем сообщении:",
-        reply_markup=build_main_keyboard(),
+        reply_markup=MAIN_KEYBOARD,
     )
 
 
-@router.message(ImageMenuFilter(), F.text == "Выйти")
 async def cmd_image_exit(message: Message) -> None:
     """Выйти из меню изображений (аналог /start)."""
-    _chats_in_image_menu.discard(message.chat.id)
+    get_ui(message.chat.id).in_image_menu = False
     await cmd_start(message)
 
 
-@router.callback_query(F.data.startswith("img_q:"))
-async def callback_image_quality(callback: CallbackQuery) -> None:
-    """Сохранение выбора качества."""
-    value = callback.data.removeprefix("img_q:")
-    get_image_settings(callback.message.chat.id)["quality"] = value
-    await callback.answer(f"Качество: {value}")
-    text = f"Настройки обновлены.\n\n{format_image_settings_text(callback.message.chat.id)}"
-    await callback.message.answer(text, reply_markup=build_image_settings_keyboard(), parse_mode="Markdown")
+# Кнопки меню настроек изображения → обработчик
+_IMAGE_MENU_ACTIONS = {
+    "Качество": cmd_image_quality,
+    "Размер": cmd_image_size,
+    "Фон": cmd_image_background,
+    "Формат": cmd_image_format,
+    "Ввести описание": cmd_image_enter_prompt,
+    "Выйти": cmd_image_exit,
+}
 
 
-@router.callback_query(F.data.startswith("img_s:"))
-async def callback_image_size(callback: CallbackQuery) -> None:
-    """Сохранение выбора размера."""
-    value = callback.data.removeprefix("img_s:")
-    get_image_settings(callback.message.chat.id)["size"] = value
-    await callback.answer(f"Размер: {value}")
-    text = f"Настройки обновлены.\n\n{format_image_settings_text(callback.message.chat.id)}"
-    await callback.message.answer(text, reply_markup=build_image_settings_keyboard(), parse_mode="Markdown")
+class ImageMenuFilter(BaseFilter):
+    """Фильтр: чат в режиме настроек изображения и нажата кнопка меню (передаёт её обработчик)."""
+
+    async def __call__(self, message: Message) -> bool | dict:
+        if not _ui.get(message.chat.id, _EMPTY_UI).in_image_menu:
+            return False
+        action = _IMAGE_MENU_ACTIONS.get(message.text)
+        if action is None:
+            return False
+        return {"menu_action": action}
+
 
+@router.message(ImageMenuFilter())
+async def cmd_image_menu_action(message: Message, menu_action) -> None:
+    """Кнопка меню настроек изображения: один обработчик вместо отдельного на каждую кнопку."""
+    await menu_action(message)
 
-@router.callback_query(F.data.startswith("img_bg:"))
-async def callback_image_background(callback: CallbackQuery) -> None:
-    """Сохранение выбора фона."""
-    value = callback.data.removeprefix("img_bg:")
-    get_image_settings(callback.message.chat.id)["background"] = value
-    await callback.answer(f"Фон: {value}")
-    text = f"Настройки обновлены.\n\n{format_image_settings_text(callback.message.chat.id)}"
-    await callback.message.answer(text, reply_markup=build_image_settings_keyboard(), parse_mode="Markdown")
+
+# Код из callback_data (img_<код>:<значение>) → (поле ImageSettings, подпись)
+_IMG_FIELD = {
+    "q": ("quality", "Качество"),
+    "s": ("size", "Размер"),
+    "bg": ("background", "Фон"),
+    "fmt": ("output_format", "Формат"),
+}
 
 
-@router.callback_query(F.data.startswith("img_fmt:"))
-async def callback_image_format(callback: CallbackQuery) -> None:
-    """Сохранение выбора формата."""
-    value = callback.data.removeprefix("img_fmt:")
-    get_image_settings(callback.message.chat.id)["output_format"] = value
-    await callback.answer(f"Формат: {value}")
-    text = f"Настройки обновлены.\n\n{format_image_settings_text(callback.message.chat.id)}"
-    await callback.message.answer(text, reply_markup=build_image_settings_keyboard(), parse_mode="Markdown")
+@router.callback_query(F.data.regexp(r"^img_(q|s|bg|fmt):"))
+async def callback_image_setting(callback: CallbackQuery) -> None:
+    """Сохранение выбора параметра изображения (качество, размер, фон, формат)."""
+    code, _, value = callback.data.partition(":")
+    field_name, label = _IMG_FIELD[code[4:]]
+    chat_id = callback.message.chat.id
+    setattr(get_image_settings(chat_id), field_name, value)
+    await callback.answer(f"{label}: {value}")
+    text = f"Настройки обновлены.\n\n{format_image_settings_text(chat_id)}"
+    await callback.message.answer(text, reply_markup=IMAGE_SETTINGS_KEYBOARD, parse_mode="Markdown")
 
 
 async def _handle_image_request(message: Message, prompt: str) -> None:
     """Сгенерировать изображение по промпту и отправить в чат."""
     chat_id = message.chat.id
     bot = message.bot
-    keyboard = build_main_keyboard()
+    keyboard = MAIN_KEYBOARD
     settings = get_image_settings(chat_id)
     await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO)
 
     image_bytes, image_url = await generate_image(prompt, settings)
-    ext = settings.get("output_format", "png")
+    ext = settings.output_format
 
     if image_bytes:
         photo = BufferedInputFile(image_bytes, filename=f"image.{ext}")
@@ -462,12 +609,13 @@ async def _handle_image_request(message: Message, prompt: str) -> None:
 @router.message(Command("image"))
 async def cmd_image(message: Message) -> None:
     """Сгенерировать изображение по промпту из команды /image <описание> (альтернатива кнопке)."""
-    parts = (message.text or "").strip().split(maxsplit=1)
-    prompt = (parts[1] if len(parts) > 1 else "").strip()
+    # split() без аргументов сам пропускает пробелы в начале — достаточно одного strip у описания
+    parts = (message.text or "").split(maxsplit=1)
+    prompt = parts[1].strip() if len(parts) > 1 else ""
     if not prompt:
         await message.answer(
             "Укажите описание после команды: /image кот на луне",
-            reply_markup=build_main_keyboard(),
+            reply_markup=MAIN_KEYBOARD,
         )
         return
     await _handle_image_request(message, prompt)
@@ -490,7 +638,7 @@ async def callback_mode(callback: CallbackQuery) -> None:
     await callback.answer()
     await callback.message.answer(
         f"Режим изменён на: **{mode_name}**",
-        reply_markup=build_main_keyboard(),
+        reply_markup=MAIN_KEYBOARD,
         parse_mode="Markdown",
     )
 
@@ -499,13 +647,25 @@ async def callback_mode(callback: CallbackQuery) -> None:
 # handlers: текстовое сообщение (режим или вопрос к боту)
 # ---------------------------------------------------------------------------
 
-def is_mode_key(text: str) -> str | None:
-    """Проверить, является ли текст ключом одного из режимов."""
+# (prompts, ключи режимов) — пересобираем только после перезагрузки промптов
+_mode_keys_cache: tuple[dict, frozenset[str]] | None = None
+
+
+def _get_mode_keys(prompts_data: dict) -> frozenset[str]:
+    """Множество ключей режимов из промптов."""
+    global _mode_keys_cache
+    prompts = prompts_data.get("prompts", {})
+    if _mode_keys_cache is None or _mode_keys_cache[0] is not prompts:
+        _mode_keys_cache = (prompts, frozenset(prompts))
+    return _mode_keys_cache[1]
+
+
+def is_mode_key(text: str, prompts_data: dict) -> str | None:
+    """Проверить, является ли текст (уже без пробелов по краям) ключом одного из режимов."""
     if not text or len(text) > 50:
         return None
-    key = text.strip().lower()
-    prompts_data = get_prompts_data()
-    if key in prompts_data.get("prompts", {}):
+    key = text.lower()
+    if key in _get_mode_keys(prompts_data):
         return key
     return None
 
@@ -518,78 +678,78 @@ async def handle_text(message: Message) -> None:
         return
 
     # Режим «Картинка»: следующее сообщение — описание изображения
-    if message.chat.id in _chats_waiting_image_prompt:
-        _chats_waiting_image_prompt.discard(message.chat.id)
+    ui = _ui.get(message.chat.id)
+    if ui is not None and ui.waiting_image_prompt:
+        ui.waiting_image_prompt = False
         await _handle_image_request(message, text)
         return
 
+    # Промпты читаем один раз на сообщение и передаём дальше
+    prompts_data = get_prompts_data()
+
     # Проверка на выбор режима (пользователь мог написать "developer" и т.д.)
-    mode_key = is_mode_key(text)
+    mode_key = is_mode_key(text, prompts_data)
     if mode_key is not None:
         set_chat_mode(message.chat.id, mode_key)
-        prompts_data = get_prompts_data()
         mode_name = prompts_data["prompts"][mode_key].get("name", mode_key)
-        await message.answer(f"Режим изменён на: **{mode_name}**", reply_markup=build_main_keyboard(), parse_mode="Markdown")
+        await message.answer(f"Режим изменён на: **{mode_name}**", reply_markup=MAIN_KEYBOARD, parse_mode="Markdown")
         return
 
     try:
-        await _handle_openai_request(message, text)
+        await _handle_openai_request(message, text, prompts_data)
     except Exception as e:
         logger.exception("Unexpected error in handle_text: %s", e)
         await message.answer(
             "⚠️ Произошла непредвиденная ошибка. Попробуй перезапуск (кнопка «Перезапуск») или повтори позже.",
-            reply_markup=build_main_keyboard(),
+            reply_markup=MAIN_KEYBOARD,
         )
 
 
-async def _handle_openai_request(message: Message, text: str) -> None:
+async def _handle_openai_request(message: Message, text: str, prompts_data: dict) -> None:
     """Отправить запрос в OpenAI и ответить пользователю."""
     # Обычное сообщение — отправляем в OpenAI
     chat_id = message.chat.id
     bot = message.bot
-    append_user_message(chat_id, text)
-    prompts_data = get_prompts_data()
     state = get_chat_state(chat_id)
-    current_mode = state.get("mode") or prompts_data.get("default_prompt", "assistant")
-    system_prompt = get_system_prompt(prompts_data, current_mode)
-    messages = get_messages_for_api(chat_id, system_prompt)
+    current_mode = state.mode or prompts_data.get("default_prompt", "assistant")
+    system_message = get_system_message(prompts_data, current_mode)
+    # Ход сохраняется в память только после ответа модели (см. apply_turn ниже)
+    messages = build_turn_messages(chat_id, system_message, text)
 
     # Показываем «печатает...» пока ждём ответ
     stop_typing = asyncio.Event()
     typing_task = asyncio.create_task(keep_typing(bot, chat_id, stop_typing))
-    keyboard = build_main_keyboard()
+    keyboard = MAIN_KEYBOARD
 
     try:
         client = get_openai_client()
-        response = await client.chat.completions.create(
-            model=config.OPENAI_MODEL,
-            messages=messages,
+        # По таймауту не повторяем: три попытки по OPENAI_TIMEOUT — это минуты ожидания ответа
+        response = await _with_retries(
+            lambda: client.chat.completions.create(
+                model=config.OPENAI_MODEL,
+                messages=messages,
+            ),
+            retry_timeouts=False,
         )
         content: str = (response.choices[0].message.content or "").strip()
 
         # Учёт токенов: API может вернуть prompt_tokens/completion_tokens или input_tokens/output_tokens
+        inp = out = 0
         if response.usage is not None:
             u = response.usage
-            inp = getattr(u, "input_tokens", None) or getattr(u, "prompt_tokens", None) or 0
-            out = getattr(u, "output_tokens", None) or getattr(u, "completion_tokens", None) or 0
-            try:
-                usage_dict = u.model_dump() if hasattr(u, "model_dump") else vars(u)
-            except Exception:
-                usage_dict = {"prompt_tokens": inp, "completion_tokens": out}
-            logger.info(
-                "OpenAI ответ: токены в запросе=%s, токены в ответе=%s | usage=%s",
-                inp,
-                out,
-                usage_dict,
-            )
-            add_tokens(chat_id, inp, out)
-            total_in, total_out = get_chat_stats(chat_id)
-            logger.info(
-                "Накопительно по чату %s: входящие=%s, исходящие=%s",
-                chat_id,
-                total_in,
-                total_out,
-            )
+            inp, out = _usage_tokens(u)
+            # Сериализация usage — только если INFO действительно пишется
+            if logger.isEnabledFor(logging.INFO):
+                if hasattr(u, "model_dump"):
+                    usage_dict = u.model_dump()
+                else:
+                    usage_dict = {"prompt_tokens": inp, "completion_tokens": out}
+                logger.info(
+                    "OpenAI ответ: токены в запросе=%s, токены в ответе=%s | usage=%s",
+                    inp,
+                    out,
+                    usage_dict,
+                )
     except Exception as e:
         logger.exception("OpenAI request failed: %s", e)
         err_msg = str(e).strip()[:300]
@@ -602,14 +762,23 @@ async def _handle_openai_request(message: Message, text: str) -> None:
         return
     finally:
         stop_typing.set()
+        # keep_typing выходит сразу, но если send_chat_action ещё в полёте — не ждём его дольше секунды
         try:
             await asyncio.wait_for(typing_task, timeout=1.0)
         except asyncio.TimeoutError:
             typing_task.cancel()
 
+    # Вопрос, ответ и токены — одно изменение памяти; запись в файл отложена и не задерживает отправку
+    total_in, total_out = apply_turn(chat_id, text, content, inp, out)
+    if response.usage is not None and logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "Накопительно по чату %s: входящие=%s, исходящие=%s",
+            chat_id,
+            total_in,
+            total_out,
+        )
     try:
         if content:
-            append_assistant_message(chat_id, content)
             chunks = split_message(content)
             for i, chunk in enumerate(chunks):
                 is_last = i == len(chunks) - 1
@@ -637,6 +806,7 @@ async def main() -> None:
     bot = Bot(token=config.BOT_TOKEN)
     dp = Dispatcher()
     dp.include_router(router)
+    dp.shutdown.register(close_openai_client)
     logger.info("Bot starting...")
     await dp.start_polling(bot)
 
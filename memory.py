@@ -1,35 +1,89 @@
 # memory.py — хранение контекста диалога (последние N сообщений пользователя и ассистента)
 
-import json
+import asyncio
+import atexit
+import functools
+import gzip
+import logging
+import os
+import queue
+import threading
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any
 
+import orjson
+
 from config import (
     MAX_ASSISTANT_MESSAGES,
     MAX_USER_MESSAGES,
+    MEMORY_DIR,
     MEMORY_JSON_PATH,
     PROMPTS_JSON_PATH,
 )
 
+logger = logging.getLogger(__name__)
+
+# Функции orjson, привязанные один раз: без поиска атрибута модуля при каждой записи и чтении
+_dumps = orjson.dumps
+_loads = orjson.loads
+
+# Степень сжатия файлов памяти: уровень 1 почти не тратит CPU, а текст ужимается в разы
+MEMORY_GZIP_LEVEL = 1
+
 
 def _load_json(path: Path) -> dict[str, Any]:
-    """Загрузить JSON-файл или вернуть пустой словарь."""
+    """Загрузить JSON-файл (*.gz — сжатый gzip) или вернуть пустой словарь."""
     if not path.exists():
         return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, OSError):
+        blob = path.read_bytes()
+        if path.suffix == ".gz":
+            blob = gzip.decompress(blob)
+        return _loads(blob)
+    except (orjson.JSONDecodeError, OSError, EOFError, zlib.error):
         return {}
 
 
-def _save_json(path: Path, data: dict[str, Any]) -> None:
-    """Сохранить данные в JSON-файл."""
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def _encode_json(path: Path, data: Any) -> bytes:
+    """
+    Содержимое JSON-файла для data: компактный JSON (UTF-8 без экранирования и отступов),
+    для файла *.gz — сжатый gzip.
+    """
+    # ChatState orjson сериализует как dataclass; default=list — для историй-deque
+    blob = _dumps(data, default=list)
+    if path.suffix == ".gz":
+        blob = gzip.compress(blob, compresslevel=MEMORY_GZIP_LEVEL, mtime=0)
+    return blob
+
+
+def _write_file_atomic(path: Path, blob: bytes) -> None:
+    """
+    Записать файл целиком: пишем во временный файл и атомарно подменяем им исходный —
+    сбой посреди записи не оставит на диске обрезанный файл.
+    """
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(blob)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
 
+def _save_json(path: Path, data: Any) -> None:
+    """Сохранить данные в JSON-файл (см. _encode_json) атомарной записью."""
+    _write_file_atomic(path, _encode_json(path, data))
 
+
+@functools.lru_cache(maxsize=4096)
 def _chat_key(chat_id: int) -> str:
+    # Ключ вычисляется на каждое обращение к памяти — для активных чатов берём из кэша
     return str(chat_id)
 
 
@@ -38,147 +92,390 @@ def _chat_key(chat_id: int) -> str:
 # ---------------------------------------------------------------------------
 
 
+DEFAULT_SYSTEM_PROMPT = "Ты — полезный помощник."
+_DEFAULT_SYSTEM_MESSAGE = {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}
+
+
 def load_prompts() -> dict[str, Any]:
-    """Загрузить prompts.json: default_prompt и prompts."""
+    """
+    Загрузить prompts.json: default_prompt и prompts.
+    system_messages — готовые system-сообщения для API по ключу режима (для get_system_message).
+    """
     data = _load_json(PROMPTS_JSON_PATH)
     prompts = data.get("prompts", {})
     default = data.get("default_prompt", "assistant")
     if default not in prompts:
         default = next(iter(prompts), "assistant")
-    return {"default_prompt": default, "prompts": prompts}
-
-
-def get_system_prompt(prompts_data: dict[str, Any], mode_key: str | None = None) -> str:
-    """Вернуть system_prompt для выбранного режима."""
-    mode_key = mode_key or prompts_data.get("default_prompt", "assistant")
-    prompts = prompts_data.get("prompts", {})
-    mode = prompts.get(mode_key, prompts.get("assistant", {}))
-    return mode.get("system_prompt", "Ты — полезный помощник.")
+    system_messages = {
+        key: {"role": "system", "content": mode.get("system_prompt", DEFAULT_SYSTEM_PROMPT)}
+        for key, mode in prompts.items()
+    }
+    return {
+        "default_prompt": default,
+        "prompts": prompts,
+        "system_messages": system_messages,
+    }
+
+
+def get_system_message(prompts_data: dict[str, Any], mode_key: str | None = None) -> dict[str, str]:
+    """
+    Вернуть готовое system-сообщение для API (один и тот же объект для режима — не изменять).
+    Неизвестный режим — как assistant. Текст берётся из prompts.json как есть и одинаков
+    для всех чатов режима: не подмешивать сюда дату, имя пользователя и т.п. — иначе OpenAI
+    не сможет закэшировать общий префикс запроса. Персонализацию добавлять в сообщения пользователя.
+    """
+    system_messages = prompts_data["system_messages"]
+    message = system_messages.get(mode_key or prompts_data["default_prompt"])
+    if message is None:
+        message = system_messages.get("assistant", _DEFAULT_SYSTEM_MESSAGE)
+    return message
 
 
 # ---------------------------------------------------------------------------
 # Память диалога по чатам
 # ---------------------------------------------------------------------------
 
-_memory_cache: dict[str, dict[str, Any]] = {}
-_prompts_cache: dict[str, Any] | None = None
-
+@dataclass(slots=True)
+class ChatState:
+    """Состояние чата: режим, последние сообщения и накопительная статистика токенов."""
 
-def _get_memory_data() -> dict[str, dict[str, Any]]:
-    """Загрузить память из файла (с кэшем в памяти)."""
-    global _memory_cache
-    if not _memory_cache:
-        _memory_cache = _load_json(MEMORY_JSON_PATH)
+    mode: str | None = None  # None = default_prompt из prompts.json
+    # deque(maxlen): append сам вытесняет старые сообщения без копирования списка
+    user_messages: deque[str] = field(default_factory=lambda: deque(maxlen=MAX_USER_MESSAGES))
+    assistant_messages: deque[str] = field(
+        default_factory=lambda: deque(maxlen=MAX_ASSISTANT_MESSAGES)
+    )
+    input_tokens: int = 0  # накопительно, не сбрасывается /reset
+    output_tokens: int = 0
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "ChatState":
+        """Восстановить состояние из словаря снимка (старые файлы могут не содержать части полей)."""
+        user_msgs = data.get("user_messages") or []
+        assistant_msgs = data.get("assistant_messages") or []
+        # В старой памяти после неудачного запроса оставалось сообщение пользователя без ответа.
+        # История хранится парами, поэтому лишние самые старые сообщения отбрасываются
+        n = min(len(user_msgs), len(assistant_msgs))
+        return cls(
+            mode=data.get("mode"),
+            user_messages=deque(user_msgs[len(user_msgs) - n :], maxlen=MAX_USER_MESSAGES),
+            assistant_messages=deque(
+                assistant_msgs[len(assistant_msgs) - n :], maxlen=MAX_ASSISTANT_MESSAGES
+            ),
+            input_tokens=data.get("input_tokens") or 0,
+            output_tokens=data.get("output_tokens") or 0,
+        )
+
+
+# Загруженные состояния чатов: ключ чата → ChatState.
+# Каждый чат хранится в своём файле MEMORY_DIR/<ключ>.json.gz и читается при первом обращении,
+# поэтому изменение одного чата перезаписывает только его файл (размер ограничен лимитами истории).
+_memory_cache: dict[str, ChatState] = {}
+_storage_ready = False  # каталог памяти создан, старый memory.json перенесён
+
+# Запись откладывается: несколько изменений подряд сохраняются одной записью файлов чатов.
+FLUSH_DELAY = 0.5  # секунды от первого несохранённого изменения до записи
+FLUSH_MAX_PENDING = 50  # после стольких изменений пишем сразу, не дожидаясь таймера
+_dirty_chats: set[str] = set()  # ключи чатов с несохранёнными изменениями
+_pending_changes = 0
+_flush_handle: asyncio.TimerHandle | None = None
+
+# Файлы пишет отдельный поток: обработчики не ждут диска (fsync).
+# Состояние сериализуется в потоке цикла (между изменениями, а не посреди них), в очередь
+# кладётся готовое содержимое (путь, байты); None — сигнал потоку завершиться.
+WRITE_RETRY_DELAY = 5.0  # секунды до повтора неудавшейся записи файла
+_write_queue: "queue.Queue[tuple[Path, bytes] | None]" = queue.Queue()
+_writer_thread: threading.Thread | None = None
+
+# Собранные сообщения для API по чатам: ключ чата → (system-сообщение, messages).
+# Не сохраняется в файл; сбрасывается при любом изменении истории чата.
+_api_messages_cache: dict[str, tuple[dict[str, str], list[dict[str, str]]]] = {}
+
+
+def _chat_path(key: str) -> Path:
+    """Файл памяти чата (JSON, сжатый gzip)."""
+    return MEMORY_DIR / f"{key}.json.gz"
+
+
+def _migrate_legacy_memory() -> None:
+    """
+    Перенести память из общего memory.json в файлы по чатам.
+    Старый файл после переноса переименовывается в memory.json.bak.
+    """
+    if not MEMORY_JSON_PATH.exists():
+        return
+    for key, state in _load_json(MEMORY_JSON_PATH).items():
+        _save_json(_chat_path(key), ChatState.from_dict(state))
+    os.replace(MEMORY_JSON_PATH, MEMORY_JSON_PATH.with_suffix(".json.bak"))
+
+
+def _get_memory_data() -> dict[str, ChatState]:
+    """Загруженные состояния чатов (при первом вызове готовит каталог памяти)."""
+    global _storage_ready, _writer_thread
+    if not _storage_ready:
+        MEMORY_DIR.mkdir(parents=True, exist_ok=True)
+        _migrate_legacy_memory()
+        # Поток записи запускается заранее: при завершении интерпретатора (atexit)
+        # новый поток создать уже нельзя
+        _writer_thread = threading.Thread(target=_writer_loop, name="memory-writer", daemon=True)
+        _writer_thread.start()
+        _storage_ready = True
     return _memory_cache
 
 
-def _persist_memory() -> None:
-    """Сохранить память в файл."""
-    global _memory_cache
-    _save_json(MEMORY_JSON_PATH, _memory_cache)
+def _get_or_create_state(key: str) -> ChatState:
+    """Состояние чата по ключу: из кэша, иначе из файла чата, иначе новое."""
+    data = _get_memory_data()
+    state = data.get(key)
+    if state is None:
+        raw = _load_json(_chat_path(key))
+        state = data[key] = ChatState.from_dict(raw) if raw else ChatState()
+    return state
 
 
-def get_chat_state(chat_id: int) -> dict[str, Any]:
+def _writer_loop() -> None:
+    """
+    Поток записи: сохранить файлы из очереди, склеивая повторные записи одного файла.
+    Содержимое, которое не удалось записать, остаётся в потоке и пишется повторно
+    через WRITE_RETRY_DELAY или вместе со следующими записями (новое содержимое файла заменяет его).
+    """
+    files: dict[Path, bytes] = {}  # ещё не записанное содержимое: путь → байты
+    stop = False
+    while not stop:
+        try:
+            # Пока есть неудавшиеся записи, ждём новых не дольше WRITE_RETRY_DELAY
+            items = [_write_queue.get(timeout=WRITE_RETRY_DELAY if files else None)]
+        except queue.Empty:
+            items = []
+        # Всё, что накопилось за время предыдущей записи, пишем одним проходом;
+        # для одного файла остаётся только последнее содержимое
+        while True:
+            try:
+                items.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in items:
+            if item is None:
+                stop = True
+                break
+            files[item[0]] = item[1]
+        for path, blob in list(files.items()):
+            try:
+                _write_file_atomic(path, blob)
+            except Exception:
+                logger.exception("Не удалось сохранить память в %s", path)
+            else:
+                del files[path]
+    if files:
+        logger.error("При завершении не сохранено файлов памяти: %d", len(files))
+
+
+def _flush_memory() -> None:
+    """Сериализовать чаты с несохранёнными изменениями и передать их потоку записи."""
+    global _flush_handle, _pending_changes
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    _pending_changes = 0
+    while _dirty_chats:
+        key = _dirty_chats.pop()
+        path = _chat_path(key)
+        _write_queue.put_nowait((path, _encode_json(path, _memory_cache[key])))
+
+
+def _stop_writer() -> None:
+    """Дописать очередь и остановить поток записи (при завершении процесса)."""
+    global _writer_thread
+    _flush_memory()
+    if _writer_thread is not None:
+        _write_queue.put_nowait(None)
+        _writer_thread.join()
+        _writer_thread = None
+
+
+def _persist_chat(key: str) -> None:
+    """
+    Отметить чат изменённым и запланировать запись его файла.
+    Внутри цикла asyncio чат передаётся потоку записи через FLUSH_DELAY (таймер цикла —
+    без гонок с обработчиками), вне цикла — сразу.
+    """
+    global _flush_handle, _pending_changes
+    _dirty_chats.add(key)
+    _pending_changes += 1
+    if _pending_changes >= FLUSH_MAX_PENDING:
+        _flush_memory()
+        return
+    if _flush_handle is None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _flush_memory()
+            return
+        _flush_handle = loop.call_later(FLUSH_DELAY, _flush_memory)
+
+
+# Несохранённые изменения записываются при завершении процесса
+atexit.register(_stop_writer)
+
+
+def get_chat_state(chat_id: int) -> ChatState:
     """Получить состояние чата: mode, user_messages, assistant_messages."""
-    key = _chat_key(chat_id)
-    data = _get_memory_data()
-    if key not in data:
-        data[key] = {
-            "mode": None,  # None = default_prompt из prompts.json
-            "user_messages": [],
-            "assistant_messages": [],
-            "input_tokens": 0,   # накопительно, не сбрасывается /reset
-            "output_tokens": 0,
-        }
-    return data[key]
+    return _get_or_create_state(_chat_key(chat_id))
 
 
 def set_chat_mode(chat_id: int, mode_key: str) -> None:
     """Установить режим (промпт) для чата."""
-    state = get_chat_state(chat_id)
-    state["mode"] = mode_key
-    _persist_memory()
+    key = _chat_key(chat_id)
+    _get_or_create_state(key).mode = mode_key
+    _persist_chat(key)
 
 
 def append_user_message(chat_id: int, text: str) -> None:
     """Добавить сообщение пользователя и обрезать до MAX_USER_MESSAGES."""
-    state = get_chat_state(chat_id)
-    state["user_messages"].append(text)
-    state["user_messages"] = state["user_messages"][-MAX_USER_MESSAGES:]
-    _persist_memory()
+    key = _chat_key(chat_id)
+    state = _get_or_create_state(key)
+    state.user_messages.append(text)
+    _api_messages_cache.pop(key, None)
+    _persist_chat(key)
 
 
 def append_assistant_message(chat_id: int, text: str) -> None:
     """Добавить ответ ассистента и обрезать до MAX_ASSISTANT_MESSAGES."""
-    state = get_chat_state(chat_id)
-    state["assistant_messages"].append(text)
-    state["assistant_messages"] = state["assistant_messages"][-MAX_ASSISTANT_MESSAGES:]
-    _persist_memory()
+    key = _chat_key(chat_id)
+    state = _get_or_create_state(key)
+    state.assistant_messages.append(text)
+    _api_messages_cache.pop(key, None)
+    _persist_chat(key)
 
 
-def get_messages_for_api(chat_id: int, system_prompt: str) -> list[dict[str, str]]:
+def get_messages_for_api(chat_id: int, system_message: dict[str, str]) -> list[dict[str, str]]:
     """
     Сформировать список сообщений для OpenAI API:
     [system], затем пары user/assistant из истории (хронологически), затем текущее user (если есть).
+    System всегда первым и без изменений — это неизменный префикс для кэша промптов OpenAI.
+    system_message — готовое сообщение из get_system_message (кладётся в список как есть).
+    Пока история и режим не менялись, возвращается тот же список — его нельзя изменять.
     """
-    state = get_chat_state(chat_id)
-    messages = [{"role": "system", "content": system_prompt}]
-    user_msgs = state.get("user_messages", [])
-    assistant_msgs = state.get("assistant_messages", [])
-    n = min(len(user_msgs), len(assistant_msgs))
-    for i in range(n):
-        messages.append({"role": "user", "content": user_msgs[i]})
-        messages.append({"role": "assistant", "content": assistant_msgs[i]})
-    if len(user_msgs) > n:
+    key = _chat_key(chat_id)
+    cached = _api_messages_cache.get(key)
+    if cached is not None and cached[0] is system_message:
+        return cached[1]
+    state = _get_or_create_state(key)
+    user_msgs = state.user_messages
+    assistant_msgs = state.assistant_messages
+    # zip останавливается на более короткой истории — отдельный min() и индексы не нужны
+    messages = [
+        system_message,
+        *(
+            m
+            for user_text, assistant_text in zip(user_msgs, assistant_msgs)
+            for m in (
+                {"role": "user", "content": user_text},
+                {"role": "assistant", "content": assistant_text},
+            )
+        ),
+    ]
+    if len(user_msgs) > len(assistant_msgs):
         messages.append({"role": "user", "content": user_msgs[-1]})
+    _api_messages_cache[key] = (system_message, messages)
     return messages
 
 
+def build_turn_messages(
+    chat_id: int, system_message: dict[str, str], user_text: str
+) -> list[dict[str, str]]:
+    """
+    Сообщения для API на новый ход: история чата и текущее сообщение пользователя.
+    Память не меняется — ход сохраняется целиком через apply_turn после ответа модели.
+    """
+    return [*get_messages_for_api(chat_id, system_message), {"role": "user", "content": user_text}]
+
+
+def apply_turn(
+    chat_id: int, user_text: str, assistant_text: str, input_tokens: int, output_tokens: int
+) -> tuple[int, int]:
+    """
+    Сохранить завершённый ход диалога одним изменением памяти: пару сообщений user/assistant
+    (если ответ не пустой) и токены. Вместо append_user_message + append_assistant_message + add_tokens.
+    Возвращает накопительные (input_tokens, output_tokens) для чата.
+    """
+    key = _chat_key(chat_id)
+    state = _get_or_create_state(key)
+    # Сообщения — только парой, чтобы история user/assistant не сдвигалась
+    if assistant_text:
+        state.user_messages.append(user_text)
+        state.assistant_messages.append(assistant_text)
+        _api_messages_cache.pop(key, None)
+    state.input_tokens += input_tokens
+    state.output_tokens += output_tokens
+    _persist_chat(key)
+    return state.input_tokens, state.output_tokens
+
+
 def reset_chat(chat_id: int) -> None:
     """Очистить историю сообщений чата (режим и статистику токенов не трогаем)."""
     key = _chat_key(chat_id)
-    data = _get_memory_data()
-    if key in data:
-        data[key]["user_messages"] = []
-        data[key]["assistant_messages"] = []
-        _persist_memory()
+    if key in _get_memory_data() or _chat_path(key).exists():
+        state = _get_or_create_state(key)
+        state.user_messages.clear()
+        state.assistant_messages.clear()
+        _api_messages_cache.pop(key, None)
+        _persist_chat(key)
 
 
 def get_chat_stats(chat_id: int) -> tuple[int, int]:
     """Вернуть (input_tokens, output_tokens) для чата."""
     state = get_chat_state(chat_id)
-    return (
-        state.get("input_tokens") or 0,
-        state.get("output_tokens") or 0,
-    )
+    return state.input_tokens, state.output_tokens
 
 
-def add_tokens(chat_id: int, input_tokens: int, output_tokens: int) -> None:
-    """Добавить токены к накопительной статистике чата."""
-    state = get_chat_state(chat_id)
-    state["input_tokens"] = (state.get("input_tokens") or 0) + input_tokens
-    state["output_tokens"] = (state.get("output_tokens") or 0) + output_tokens
-    _persist_memory()
+def add_tokens(chat_id: int, input_tokens: int, output_tokens: int) -> tuple[int, int]:
+    """Добавить токены к накопительной статистике чата и вернуть новые (input_tokens, output_tokens)."""
+    key = _chat_key(chat_id)
+    state = _get_or_create_state(key)
+    state.input_tokens += input_tokens
+    state.output_tokens += output_tokens
+    _persist_chat(key)
+    return state.input_tokens, state.output_tokens
 
 
 def reset_chat_stats(chat_id: int) -> None:
     """Обнулить статистику токенов для чата."""
-    state = get_chat_state(chat_id)
-    state["input_tokens"] = 0
-    state["output_tokens"] = 0
-    _persist_memory()
+    key = _chat_key(chat_id)
+    state = _get_or_create_state(key)
+    state.input_tokens = 0
+    state.output_tokens = 0
+    _persist_chat(key)
+
+
+def _prompts_file_mtime() -> float | None:
+    """Время изменения prompts.json (None, если файла нет)."""
+    try:
+        return PROMPTS_JSON_PATH.stat().st_mtime
+    except OSError:
+        return None
 
 
 def get_prompts_data() -> dict[str, Any]:
-    """Загрузить промпты (с кэшем)."""
-    global _prompts_cache
-    if _prompts_cache is None:
-        _prompts_cache = load_prompts()
+    """Промпты, загруженные при импорте модуля (или при последней перезагрузке)."""
     return _prompts_cache
 
 
 def reload_prompts() -> dict[str, Any]:
     """Перезагрузить prompts.json (например, после изменения файла)."""
-    global _prompts_cache
+    global _prompts_cache, _prompts_mtime
+    _prompts_mtime = _prompts_file_mtime()
     _prompts_cache = load_prompts()
     return _prompts_cache
+
+
+def maybe_reload_prompts() -> dict[str, Any]:
+    """Перезагрузить prompts.json, только если файл изменился с последней загрузки (один stat)."""
+    if _prompts_file_mtime() != _prompts_mtime:
+        return reload_prompts()
+    return _prompts_cache
+
+
+# Промпты читаются один раз при импорте; get_prompts_data() — просто чтение глобальной переменной
+_prompts_mtime = _prompts_file_mtime()
+_prompts_cache: dict[str, Any] = load_prompts()